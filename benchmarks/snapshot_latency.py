@@ -0,0 +1,82 @@
+'''
+Compare filter/group_by latency on the on-disk connection against an
+in-memory snapshot (connect(in_memory=True)).
+
+Usage:
+    python benchmarks/snapshot_latency.py --rows 1000000 --repeat 20
+'''
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+from tidysqlite import tidyDB
+
+
+def build_database(path,rows):
+    '''Write a GTD-like events table with `rows` rows.'''
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(dict(eventid=np.arange(rows),
+                             iyear=rng.integers(1970,2019,rows),
+                             country_txt=[f"country{i}" for i in rng.integers(0,200,rows)],
+                             nkill=rng.integers(0,50,rows),
+                             latitude=rng.uniform(-60,70,rows),
+                             longitude=rng.uniform(-180,180,rows)))
+    conn = sqlite3.connect(path)
+    data.to_sql("events",conn,index=False)
+    conn.close()
+
+
+PIPELINES = {
+    "filter": lambda db: db.tbl("events").filter("iyear = 2000 and nkill > 10").select("eventid,country_txt,nkill").collect(),
+    "group_by": lambda db: db.tbl("events").group_by("country_txt").count().collect(),
+    "filter + group_by": lambda db: db.tbl("events").filter("iyear >= 2010").group_by("country_txt").mean("nkill").collect(),
+}
+
+
+def time_pipeline(db,pipeline,repeat):
+    '''Return the median and minimum latency (ms) of a pipeline after one warm-up run.'''
+    pipeline(db)
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        pipeline(db)
+        times.append((time.perf_counter() - started)*1000)
+    return np.median(times), min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows",type=int,default=1000000)
+    parser.add_argument("--repeat",type=int,default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp,"events.sqlite")
+        build_database(path,args.rows)
+        disk = tidyDB(path)
+        started = time.perf_counter()
+        memory = tidyDB(path,in_memory=True)
+        snapshot_ms = (time.perf_counter() - started)*1000
+
+        results = []
+        for name, pipeline in PIPELINES.items():
+            disk_median, disk_min = time_pipeline(disk,pipeline,args.repeat)
+            mem_median, mem_min = time_pipeline(memory,pipeline,args.repeat)
+            results.append([name,disk_median,disk_min,mem_median,mem_min,disk_median/mem_median])
+        disk.close()
+        memory.close()
+
+    print(f"{args.rows} rows, {args.repeat} runs per pipeline, snapshot copy took {snapshot_ms:.1f} ms\n")
+    print(tabulate(results,headers=["pipeline","disk median (ms)","disk min (ms)",
+                                    "memory median (ms)","memory min (ms)","speedup"],floatfmt=".2f"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,15 @@
-from tidysqlite.tidysqlite import tidyDB
+from tidysqlite.tidysqlite import tidyDB, QueryTimeout, LoggingSink, RingBufferSink, JSONLinesSink
 
 __all__ = [
+    'QueryTimeout',
+    'LoggingSink',
+    'RingBufferSink',
+    'JSONLinesSink',
     'tidyDB.connect',
     'tidyDB.is_connected',
+    'tidyDB.snapshot',
+    'tidyDB.refresh',
+    'tidyDB.worker',
     'tidyDB.select',
     'tidyDB.filter',
     'tidyDB.arrange',
@@ -14,18 +21,41 @@ __all__ = [
     'tidyDB.max',
     'tidyDB.min',
     'tidyDB.range',
+    'tidyDB.slice_max',
+    'tidyDB.slice_min',
+    'tidyDB.slice_head',
     'tidyDB.custom_query',
+    'tidyDB.interrupt',
+    'tidyDB.trace',
+    'tidyDB.untrace',
+    'tidyDB.query_stats',
     'tidyDB.clear',
     'tidyDB.unarrange',
     'tidyDB.unfilter',
     'tidyDB.ungroup',
+    'tidyDB.unsearch',
+    'tidyDB.unslice',
+    'tidyDB.search',
+    'tidyDB.create_fts_index',
+    'tidyDB.create_spatial_index',
+    'tidyDB.filter_bbox',
+    'tidyDB.filter_radius',
+    'tidyDB.unfilter_spatial',
     'tidyDB.unselected',
     'tidyDB.pipe_on',
     'tidyDB.pipe_off',
     'tidyDB.collect',
     'tidyDB.head',
+    'tidyDB.page',
+    'tidyDB.paginate',
     'tidyDB.create_database',
     'tidyDB.create_table',
+    'tidyDB.upsert',
+    'tidyDB.update',
+    'tidyDB.delete_rows',
     'tidyDB.list_fields',
     'tidyDB.select_table',
+    'tidyDB.optimize',
+    'tidyDB.maintenance',
+    'tidyDB.close',
 ]
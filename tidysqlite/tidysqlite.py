@@ -6,36 +6,127 @@ Motivation:
 '''
 
 import pandas as pd
+import numpy as np
 import sqlite3
 import os
+import copy
+import time
+import datetime
+import math
+import json
+import base64
+import logging
+from collections import deque
 from tabulate import tabulate
 
+class QueryTimeout(Exception):
+    '''
+    Raised when a query exceeds its time or VM step budget, or is interrupted.
+    '''
+    pass
+
+class LoggingSink:
+    '''
+    Trace sink that writes each query event to a logger.
+    '''
+    def __init__(self,logger=None,level=logging.INFO):
+        self.logger = logging.getLogger("tidysqlite") if logger is None else logger
+        self.level = level
+
+    def __call__(self,event):
+        self.logger.log(self.level,"%.4fs (execute %.4fs, fetch %.4fs, convert %.4fs) %d rows: %s",
+                        event["total_time"],event["execute_time"],event["fetch_time"],
+                        event["convert_time"],event["rows"],event["sql"])
+
+class RingBufferSink:
+    '''
+    Trace sink that keeps the last `size` query events in memory.
+    '''
+    def __init__(self,size=1000):
+        self.events = deque(maxlen=size)
+
+    def __call__(self,event):
+        self.events.append(event)
+
+    def to_frame(self):
+        '''Return the buffered events as a data frame.'''
+        return pd.DataFrame(list(self.events))
+
+class JSONLinesSink:
+    '''
+    Trace sink that appends each query event as a line of JSON to a file.
+    '''
+    def __init__(self,path):
+        self.path = os.path.expanduser(path)
+
+    def __call__(self,event):
+        with open(self.path,"a") as f:
+            f.write(json.dumps(event,default=str) + "\n")
+
 class tidyDB:
     '''
     Method for easy manipulation of a SQLite database using sqlite3.
     '''
-    def __init__(self,db_file=""):
+    # Shadow tables SQLite creates for each kind of virtual table index.
+    shadow_suffixes = {"fts": ["data","idx","content","docsize","config"],
+                       "rtree": ["node","rowid","parent"]}
+
+    def __init__(self,db_file="",timeout=None,max_vm_steps=None,progress=None,
+                 in_memory=False,shared=False):
         self.db_loc = ""
         self.conn = None
+        self.source_conn = None
+        self.snapshot_version = None
+        self.snapshot_shared = False
+        self.snapshot_uri = None
+        self.timeout = None
+        self.max_vm_steps = None
+        self.progress = None
+        self.progress_interval = 1000
+        self.trace_sinks = []
+        self.trace_stats = {}
+        self.trace_deep_bytes = False
+        self.optimize_after_rows = 100000
         self.tables = None
+        self.index_tables = []
         self.target_table = None
         self.fields = None
+        self.schema = {}
         self.pipe_status = True
         self.selected_fields = "*"
         self.filter_statement = ""
         self.groupby_statement = ""
         self.arrange_statement = ""
+        self.arranged_vars = []
         self.distinct_statement = ""
+        self.join_statement = ""
+        self.joins = {}
+        self.slice_specs = []
+        self.grouped_vars = []
+        self.grouping_sliced = False
         self.prior_query = None
-        self.connect(db_file=db_file)
+        self.connect(db_file=db_file,timeout=timeout,
+                     max_vm_steps=max_vm_steps,progress=progress,
+                     in_memory=in_memory,shared=shared)
 
-    def connect(self,db_file=""):
+    def connect(self,db_file="",timeout=None,max_vm_steps=None,progress=None,
+                in_memory=False,shared=False):
         """Establish a connection to an existing local SQLite database.
 
         Parameters
         ----------
         db_file : str
             File path to SQLite database object.
+        timeout : float
+            Default number of seconds any query on this connection may run before raising QueryTimeout.
+        max_vm_steps : int
+            Default number of SQLite virtual machine steps any query on this connection may take.
+        progress : callable
+            Default function called as progress(vm_steps, rows_fetched) while a query runs.
+        in_memory : bool
+            Copy the database into an in-memory snapshot and run all queries against it (see .snapshot()).
+        shared : bool
+            Make the in-memory snapshot read-only and shareable with other threads through .worker().
 
         Returns
         -------
@@ -55,17 +146,166 @@ class tidyDB:
         """
         db_file_complete = os.path.expanduser(db_file)
         if os.path.exists(db_file_complete):
+            if self.source_conn is not None or self.snapshot_uri is not None:
+                self.conn.close() # previous in-memory snapshot
+            if self.source_conn is not None:
+                self.source_conn.close()
             self.db_loc = db_file_complete
             self.conn = sqlite3.connect(db_file_complete)
+            self.source_conn = None
+            self.snapshot_version = None
+            self.snapshot_shared = False
+            self.snapshot_uri = None
+            self.timeout = timeout
+            self.max_vm_steps = max_vm_steps
+            self.progress = progress
             self.tables = None
             self.target_table = None
             self.fields = None
+            self.schema = {}
             self.prior_query = None
             self.clear()
+            if in_memory:
+                self.snapshot(shared=shared)
             self.gather_tables()
         else:
             raise FileExistsError(f"The file path {db_file_complete} does not exist. Please specify a new file path or create a new database with .create_database().")
 
+    def snapshot(self,shared=False):
+        """Copy the connected database into memory and query the copy.
+
+        The on-disk file is copied into a ':memory:' connection with the
+        SQLite backup API. The file connection is kept open as the source so
+        that .refresh() can detect changes made to it. Write methods raise
+        ValueError on a snapshot, since the copy is never saved to the file.
+
+        Parameters
+        ----------
+        shared : bool
+            If True, the snapshot is a read-only (PRAGMA query_only) shared-cache
+            in-memory database that other threads open with .worker(). The
+            tidyDB object itself, like its connection, stays single-threaded:
+            each thread needs its own connection and query state.
+
+        Returns
+        -------
+        None
+            Replaces the active connection with the in-memory snapshot.
+
+        Examples
+        -------
+        from tidysqlite import tidyDB
+        db = tidyDB("~/my_database.sqlite")
+        db.snapshot()
+        """
+        self.is_connected()
+        if self.source_conn is None:
+            self.source_conn = self.conn
+        else:
+            self.conn.close()
+        if shared:
+            self.snapshot_uri = f"file:tidysqlite-{id(self)}-{time.monotonic_ns()}?mode=memory&cache=shared"
+            mem = sqlite3.connect(self.snapshot_uri,uri=True)
+        else:
+            self.snapshot_uri = None
+            mem = sqlite3.connect(":memory:")
+        self.source_conn.backup(mem)
+        if shared:
+            mem.execute("PRAGMA query_only = ON")
+        self.conn = mem
+        self.snapshot_shared = shared
+        self.snapshot_version = self.source_version()
+
+    def worker(self):
+        """Open a tidyDB on the shared in-memory snapshot for use in another thread.
+
+        The worker has its own connection to the same in-memory database
+        (shared cache, no copy) and its own query state, progress handler and
+        trace callbacks, so threads do not interfere. Call it from the thread
+        that will use the worker. Workers see the snapshot they were opened on;
+        open new ones after .refresh().
+
+        Returns
+        -------
+        tidyDB
+            Read-only query object bound to the snapshot.
+
+        Raises
+        ------
+        ValueError
+            When the connection is not a shared snapshot (snapshot(shared=True)).
+
+        Examples
+        -------
+        from concurrent.futures import ThreadPoolExecutor
+        db = tidyDB("~/my_database.sqlite",in_memory=True,shared=True)
+        def count(year):
+            return db.worker().tbl("gtd").filter(f"iyear == {year}").collect()
+        with ThreadPoolExecutor(4) as pool:
+            frames = list(pool.map(count,range(2000,2010)))
+        """
+        self.is_connected()
+        if self.snapshot_uri is None:
+            raise ValueError("No shared snapshot to open. Use .snapshot(shared=True) or connect(in_memory=True,shared=True).")
+        worker = copy.copy(self)
+        worker.conn = sqlite3.connect(self.snapshot_uri,uri=True)
+        worker.conn.execute("PRAGMA query_only = ON")
+        worker.source_conn = None
+        worker.trace_sinks = list(self.trace_sinks)
+        worker.trace_stats = {}
+        worker.schema = dict(self.schema)
+        worker.target_table = None
+        worker.fields = None
+        worker.prior_query = None
+        worker.clear()
+        return worker
+
+    def is_writable(self):
+        '''
+        [Aux] Ensure writes go to the database file rather than an in-memory snapshot,
+        where they would be lost on the next refresh().
+        '''
+        self.is_connected()
+        if self.source_conn is not None or self.snapshot_uri is not None:
+            raise ValueError("Connected to an in-memory snapshot; writes would not reach the database file. "
+                             "Write through a file connection (connect(in_memory=False)) and call .refresh() on the snapshot.")
+
+    def source_version(self):
+        '''
+        [Aux] Return the (data_version, mtime) pair of the source database file.
+        '''
+        data_version = self.source_conn.execute("PRAGMA data_version").fetchone()[0]
+        return (data_version,os.path.getmtime(self.db_loc))
+
+    def refresh(self,force=False):
+        """Re-sync the in-memory snapshot when the source file has changed.
+
+        Parameters
+        ----------
+        force : bool
+            Re-copy the source even if no change was detected.
+
+        Returns
+        -------
+        bool
+            True if the snapshot was refreshed.
+
+        Raises
+        ------
+        ValueError
+            When the connection is not an in-memory snapshot.
+        """
+        if self.source_conn is None:
+            raise ValueError("No in-memory snapshot to refresh. Use .snapshot() or connect(in_memory=True).")
+        if force or self.source_version() != self.snapshot_version:
+            self.snapshot(shared=self.snapshot_shared)
+            self.tables = None
+            self.fields = None
+            self.schema = {}
+            self.gather_tables()
+            return True
+        return False
+
     def is_connected(self):
         """Check if a connection to a SQLite database has been established.
         Serves as an internal check to ensure a connection is established before performing any query operations
@@ -96,8 +336,27 @@ class tidyDB:
         self.is_connected()
         if self.tables is None:
             cursor = self.conn.cursor()
-            tables = cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-            self.tables = [i[0] for i in tables]
+            names = [i[0] for i in cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")]
+            # Index tables built by tidysqlite (recorded in tidysqlite_indexes) and
+            # their shadow tables are kept apart from the user tables.
+            self.index_tables = []
+            if "tidysqlite_indexes" in names:
+                built = cursor.execute("SELECT name, kind FROM tidysqlite_indexes").fetchall()
+                shadow = [f"{name}_{suffix}" for name, kind in built for suffix in self.shadow_suffixes[kind]]
+                self.index_tables = [name for name in names
+                                     if name == "tidysqlite_indexes" or name in shadow
+                                     or name in [b[0] for b in built]]
+            self.tables = [name for name in names
+                           if name not in self.index_tables and not name.startswith("sqlite_")]
+
+    def record_index(self,name,table_name,kind,columns):
+        '''
+        [Aux] Record an index built by tidysqlite, with the fields it covers, in tidysqlite_indexes.
+        '''
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS tidysqlite_indexes
+                             (name TEXT PRIMARY KEY, table_name TEXT, kind TEXT, columns TEXT)""")
+        self.conn.execute("INSERT OR REPLACE INTO tidysqlite_indexes VALUES (?,?,?,?)",
+                          (name,table_name,kind,",".join(columns)))
 
     def tbl(self,table_name=""):
         """Load a specific data from the connect SQLite database.
@@ -152,7 +411,18 @@ class tidyDB:
         [Aux.] Gather all available fields
         '''
         self.is_connected()
-        self.fields = pd.read_sql(f"SELECT * FROM '{self.target_table}' LIMIT 1",self.conn).columns.values.tolist()
+        self.fields = self.run_query(f"SELECT * FROM '{self.target_table}' LIMIT 1").columns.values.tolist()
+
+    def gather_schema(self,table_name=None):
+        '''
+        [Aux.] Gather the declared column types of a table from the schema catalog.
+        '''
+        self.is_connected()
+        table_name = self.target_table if table_name is None else table_name
+        if table_name not in self.schema:
+            info = self.conn.execute(f"PRAGMA table_info('{table_name}')").fetchall()
+            self.schema[table_name] = {col[1]: col[2].upper() for col in info}
+        return self.schema[table_name]
 
     def list_fields(self,print_span = 7):
         """List all fields within the selected table.
@@ -303,18 +573,21 @@ class tidyDB:
         Example:
             db.arrange("desc(var1),var2")
         '''
+        self.arranged_vars = self.parse_arrange(query)
+        self.arrange_statement = "order by " + ", ".join([f"{var} {order}" for var, order in self.arranged_vars])
+        if self.pipe_status:
+            return self
+
+    def parse_arrange(self,query):
+        '''
+        [Aux] Parse an arrange() string into a list of (variable, "asc"/"desc") pairs.
+        '''
         def clean(var):
             if "desc(" in var:
-                var = var.replace("desc(","").replace(")","").strip()
-                var += " desc"
-            else:
-                var += " asc"
-            return var
+                return (var.replace("desc(","").replace(")","").strip(),"desc")
+            return (var,"asc")
 
-        entries = [clean(var.strip()) for var in query.split(',')]
-        self.arrange_statement = "order by " + ", ".join(entries)
-        if self.pipe_status:
-            return self
+        return [clean(var.strip()) for var in query.split(',')]
 
     def rename(self,query):
         '''
@@ -353,6 +626,284 @@ class tidyDB:
         if self.pipe_status:
             return self
 
+    def render_fields(self):
+        '''
+        [Aux] Render the selected fields, restricting "*" to the queued table when a join is active.
+        '''
+        if self.selected_fields == "*" and len(self.slice_specs) > 0:
+            self.gather_fields()
+            return ", ".join(f'"{f}"' for f in self.fields)
+        if self.selected_fields == "*" and self.join_statement != "":
+            return f'"{self.target_table}".*'
+        return self.selected_fields
+
+    def render_from(self):
+        '''
+        [Aux] Render the FROM clause: the queued table with its joins, or the
+        ROW_NUMBER() subqueries when slice verbs are active (one per slice, each
+        applied to the rows kept by the one before).
+        '''
+        source = f"'{self.target_table}' {self.join_statement}".strip()
+        if len(self.slice_specs) == 0:
+            return source
+        columns, where = f'"{self.target_table}".*', self.filter_statement
+        for i, (partition, order, n, func) in enumerate(self.slice_specs):
+            window = ("partition by " + ", ".join(partition) + " " if len(partition) > 0 else "") + "order by " + order
+            source = f"""(SELECT {columns}, {func}() over ({window}) as tidy_row_number
+                         FROM {source} {where}) as "{self.target_table}"
+                      """.strip()
+            if i == 0:
+                self.gather_fields()
+                columns = ", ".join(f'"{f}"' for f in self.fields)
+            where = f"where tidy_row_number <= {n}"
+        return source
+
+    def render_where(self):
+        '''
+        [Aux] Render the WHERE clause. With a slice the filter moves into the subquery.
+        '''
+        if len(self.slice_specs) == 0:
+            return self.filter_statement
+        return f"where tidy_row_number <= {self.slice_specs[-1][2]}"
+
+    def render_groupby(self):
+        '''
+        [Aux] Render the GROUP BY clause. A slice verb uses the group_by() variables
+        as its partition instead, until an aggregate verb groups by them again.
+        '''
+        if self.grouping_sliced:
+            return ""
+        return self.groupby_statement
+
+    # Full-text search
+    def create_fts_index(self,table_name="",columns=""):
+        """Build an FTS5 full-text index over text fields of a table.
+
+        The index is an external-content FTS5 table named '<table>_fts' that
+        reads its text from the base table. Insert, update and delete triggers
+        keep it in sync with the base table. Re-running the method rebuilds
+        the index (e.g. after create_table(overwrite=True)).
+
+        Parameters
+        ----------
+        table_name : str
+            Name of existing table in connected SQLite database.
+        columns : str
+            Comma separated text fields to index, e.g. "summary,motive".
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError
+            When the table or fields do not exist.
+
+        Examples
+        -------
+        db.create_fts_index("gtd","summary")
+        db.tbl("gtd").search("bomb NEAR/3 market",rank=True).select("eventid,summary").head()
+        """
+        self.is_writable()
+        self.gather_tables()
+        if table_name not in self.tables:
+            raise ValueError(f"{table_name} not in available tables.")
+        cols = [c.strip() for c in columns.split(",") if c.strip() != ""]
+        missing = [c for c in cols if c not in self.gather_schema(table_name)]
+        if len(cols) == 0 or len(missing) > 0:
+            raise ValueError(f"Specify existing fields of '{table_name}' to index. Unknown: {', '.join(missing)}")
+        fts = f"{table_name}_fts"
+        quoted = ", ".join(f'"{c}"' for c in cols)
+        new = ", ".join(f'new."{c}"' for c in cols)
+        old = ", ".join(f'old."{c}"' for c in cols)
+        with self.conn:
+            for suffix in ("ai","ad","au"):
+                self.conn.execute(f'DROP TRIGGER IF EXISTS "{fts}_{suffix}"')
+            self.conn.execute(f'DROP TABLE IF EXISTS "{fts}"')
+            self.conn.execute(f"""CREATE VIRTUAL TABLE "{fts}" USING fts5({quoted},
+                                  content='{table_name}', content_rowid='rowid')""")
+            self.conn.execute(f"""CREATE TRIGGER "{fts}_ai" AFTER INSERT ON "{table_name}" BEGIN
+                                  INSERT INTO "{fts}"(rowid, {quoted}) VALUES (new.rowid, {new});
+                                  END""")
+            self.conn.execute(f"""CREATE TRIGGER "{fts}_ad" AFTER DELETE ON "{table_name}" BEGIN
+                                  INSERT INTO "{fts}"("{fts}", rowid, {quoted}) VALUES ('delete', old.rowid, {old});
+                                  END""")
+            self.conn.execute(f"""CREATE TRIGGER "{fts}_au" AFTER UPDATE ON "{table_name}" BEGIN
+                                  INSERT INTO "{fts}"("{fts}", rowid, {quoted}) VALUES ('delete', old.rowid, {old});
+                                  INSERT INTO "{fts}"(rowid, {quoted}) VALUES (new.rowid, {new});
+                                  END""")
+            self.conn.execute(f"""INSERT INTO "{fts}"("{fts}") VALUES ('rebuild')""")
+            self.record_index(fts,table_name,"fts",cols)
+        self.tables = None
+        self.gather_tables()
+
+    def search(self,query,rank=False):
+        '''
+        Restrict the queued table to rows matching an FTS5 query (see create_fts_index()).
+
+        The match is joined back to the table by rowid, so it composes with
+        select(), filter(), arrange() and head(). rank=True orders results by
+        relevance (bm25); a later arrange() overrides it.
+
+        Example:
+            db.tbl("gtd").search("bomb OR explosive",rank=True).filter("iyear > 2000").head()
+        '''
+        self.is_queued()
+        fts = f"{self.target_table}_fts"
+        self.gather_tables()
+        if fts not in self.index_tables:
+            raise ValueError(f"No full-text index on '{self.target_table}'. Create one with .create_fts_index().")
+        match = query.replace("'","''")
+        self.set_join("search",f"""join (SELECT rowid as tidy_fts_rowid, rank as tidy_fts_rank
+                                         FROM "{fts}" WHERE "{fts}" MATCH '{match}') as tidy_fts
+                                   on tidy_fts.tidy_fts_rowid = "{self.target_table}".rowid""")
+        if rank:
+            self.arranged_vars = [("tidy_fts.tidy_fts_rank","asc")]
+            self.arrange_statement = "order by tidy_fts.tidy_fts_rank asc"
+        if self.pipe_status:
+            return self
+
+    def set_join(self,name,statement):
+        '''
+        [Aux] Set (or clear with None) a named join and rebuild the join statement.
+        '''
+        if statement is None:
+            self.joins.pop(name,None)
+        else:
+            self.joins[name] = statement
+        self.join_statement = "\n".join(self.joins.values())
+
+    # Spatial filtering
+    def create_spatial_index(self,lat="latitude",lon="longitude",table_name=""):
+        """Build an R*Tree index over latitude/longitude fields of a table.
+
+        The index is an R*Tree virtual table named '<table>_rtree' keyed by
+        the base table rowid. Insert, update and delete triggers keep it in
+        sync; rows with a NULL coordinate are left out. Re-running the method
+        rebuilds the index.
+
+        Parameters
+        ----------
+        lat : str
+            Latitude field.
+        lon : str
+            Longitude field.
+        table_name : str
+            Table to index. Defaults to the queued table.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError
+            When the table or fields do not exist.
+
+        Examples
+        -------
+        db.create_spatial_index("latitude","longitude",table_name="gtd")
+        db.tbl("gtd").filter_bbox(33.0,37.5,35.0,42.5).select("eventid,city").collect()
+        """
+        self.is_writable()
+        self.gather_tables()
+        if table_name == "":
+            self.is_queued()
+            table_name = self.target_table
+        if table_name not in self.tables:
+            raise ValueError(f"{table_name} not in available tables.")
+        missing = [c for c in (lat,lon) if c not in self.gather_schema(table_name)]
+        if len(missing) > 0:
+            raise ValueError(f"Fields {', '.join(missing)} not in table '{table_name}'.")
+        rtree = f"{table_name}_rtree"
+        insert = f"""INSERT INTO "{rtree}" VALUES (new.rowid, new."{lat}", new."{lat}", new."{lon}", new."{lon}")"""
+        present = f'new."{lat}" IS NOT NULL AND new."{lon}" IS NOT NULL'
+        with self.conn:
+            for suffix in ("ai","ad","au"):
+                self.conn.execute(f'DROP TRIGGER IF EXISTS "{rtree}_{suffix}"')
+            self.conn.execute(f'DROP TABLE IF EXISTS "{rtree}"')
+            self.conn.execute(f'CREATE VIRTUAL TABLE "{rtree}" USING rtree(tidy_rowid, tidy_min_lat, tidy_max_lat, tidy_min_lon, tidy_max_lon)')
+            self.conn.execute(f"""CREATE TRIGGER "{rtree}_ai" AFTER INSERT ON "{table_name}"
+                                  WHEN {present} BEGIN {insert}; END""")
+            self.conn.execute(f"""CREATE TRIGGER "{rtree}_ad" AFTER DELETE ON "{table_name}" BEGIN
+                                  DELETE FROM "{rtree}" WHERE tidy_rowid = old.rowid; END""")
+            self.conn.execute(f"""CREATE TRIGGER "{rtree}_au" AFTER UPDATE ON "{table_name}" BEGIN
+                                  DELETE FROM "{rtree}" WHERE tidy_rowid = old.rowid;
+                                  INSERT INTO "{rtree}" SELECT new.rowid, new."{lat}", new."{lat}", new."{lon}", new."{lon}"
+                                  WHERE {present}; END""")
+            self.conn.execute(f"""INSERT INTO "{rtree}" SELECT rowid, "{lat}", "{lat}", "{lon}", "{lon}"
+                                  FROM "{table_name}" WHERE "{lat}" IS NOT NULL AND "{lon}" IS NOT NULL""")
+            self.record_index(rtree,table_name,"rtree",[lat,lon])
+        self.tables = None
+        self.gather_tables()
+
+    def spatial_join(self,min_lat,max_lat,min_lon,max_lon,condition=""):
+        '''
+        [Aux] Join the queued table to its R*Tree index on a bounding box. A box with
+        min_lon > max_lon crosses the antimeridian and is looked up as two boxes,
+        one on each side of ±180.
+        '''
+        self.is_queued()
+        rtree = f"{self.target_table}_rtree"
+        self.gather_tables()
+        if rtree not in self.index_tables:
+            raise ValueError(f"No spatial index on '{self.target_table}'. Create one with .create_spatial_index().")
+        if float(min_lon) <= float(max_lon):
+            lon_ranges = [(min_lon,max_lon)]
+        else:
+            lon_ranges = [(min_lon,180.0),(-180.0,max_lon)]
+        boxes = [f"""SELECT * FROM "{rtree}"
+                     WHERE tidy_max_lat >= {float(min_lat)} AND tidy_min_lat <= {float(max_lat)}
+                     AND tidy_max_lon >= {float(lo)} AND tidy_min_lon <= {float(hi)}""" for lo, hi in lon_ranges]
+        source = f'"{rtree}"' if len(boxes) == 1 else "(" + " UNION ALL ".join(boxes) + ")"
+        box = "" if len(boxes) > 1 else f"""and tidy_rtree.tidy_max_lat >= {float(min_lat)} and tidy_rtree.tidy_min_lat <= {float(max_lat)}
+                                    and tidy_rtree.tidy_max_lon >= {float(min_lon)} and tidy_rtree.tidy_min_lon <= {float(max_lon)}"""
+        self.set_join("spatial",f"""join {source} as tidy_rtree
+                                    on tidy_rtree.tidy_rowid = "{self.target_table}".rowid
+                                    {box}
+                                    {condition}""")
+
+    def filter_bbox(self,min_lat,max_lat,min_lon,max_lon):
+        '''
+        Keep rows whose coordinates fall inside a bounding box, using the R*Tree index
+        (see create_spatial_index()). Composes with filter(), select(), group_by(), etc.
+        A box crossing the antimeridian is given with min_lon > max_lon, e.g. 170 to -170.
+
+        Example:
+            db.tbl("gtd").filter_bbox(33.0,37.5,35.0,42.5).filter("iyear > 2010").collect()
+        '''
+        self.spatial_join(min_lat,max_lat,min_lon,max_lon)
+        if self.pipe_status:
+            return self
+
+    def filter_radius(self,lat,lon,km):
+        '''
+        Keep rows within `km` kilometers of a point. The R*Tree index narrows the
+        rows to the enclosing bounding box; an equirectangular distance check
+        then drops the corners (accurate for radii up to a few hundred km).
+        Boxes and longitude differences wrap around the antimeridian.
+
+        Example:
+            db.tbl("gtd").filter_radius(33.31,44.36,25).count()
+        '''
+        km_lat = 111.32
+        km_lon = km_lat*max(math.cos(math.radians(lat)),1e-6)
+        dlat, dlon = km/km_lat, km/km_lon
+        if dlon >= 180:
+            min_lon, max_lon = -180.0, 180.0
+        else:
+            # Wrap the box edges into [-180, 180]; min_lon > max_lon marks a crossing.
+            min_lon, max_lon = (lon - dlon + 180) % 360 - 180, (lon + dlon + 180) % 360 - 180
+        delta_lon = f"(tidy_rtree.tidy_min_lon - {float(lon)})"
+        delta_lon = f"({delta_lon} - 360*round({delta_lon}/360.0))"
+        distance = f"""and ((tidy_rtree.tidy_min_lat - {float(lat)})*{km_lat})*((tidy_rtree.tidy_min_lat - {float(lat)})*{km_lat})
+                         + ({delta_lon}*{km_lon})*({delta_lon}*{km_lon})
+                         <= {float(km)*float(km)}"""
+        self.spatial_join(lat - dlat,lat + dlat,min_lon,max_lon,condition=distance)
+        if self.pipe_status:
+            return self
+
     # Summarization/aggregation methods
     def group_by(self,query):
         '''
@@ -361,13 +912,23 @@ class tidyDB:
         self.is_queued()
         self.grouped_vars = [v.strip() for v in query.split(",")]
         self.groupby_statement = "group by " + ", ".join(self.grouped_vars)
+        self.grouping_sliced = False
         if self.pipe_status:
             return self
 
     def is_grouped(self):
-        if len(self.grouped_vars) > 0:
-            return True
-        return False
+        '''
+        [Aux] Check for grouping variables.
+        '''
+        return len(self.grouped_vars) > 0
+
+    def aggregate(self,fields):
+        '''
+        [Aux] Select aggregate fields. After a slice verb this groups the kept
+        rows by the group_by() variables again.
+        '''
+        self.selected_fields = fields
+        self.grouping_sliced = False
 
     def mean(self,query=""):
         '''
@@ -380,7 +941,7 @@ class tidyDB:
             else:
                 vars = [v.strip() for v in query.split(",")]
                 front = ", ".join(self.grouped_vars) + ", "
-            self.selected_fields = front + ", ".join([f"avg({i}) as {i}_mean" for i in vars])
+            self.aggregate(front + ", ".join([f"avg({i}) as {i}_mean" for i in vars]))
         if self.pipe_status:
             return self
 
@@ -395,7 +956,7 @@ class tidyDB:
             else:
                 vars = [v.strip() for v in query.split(",")]
                 front = ", ".join(self.grouped_vars) + ", "
-            self.selected_fields = front + ", ".join([f"min({i}) as {i}_min" for i in vars])
+            self.aggregate(front + ", ".join([f"min({i}) as {i}_min" for i in vars]))
         if self.pipe_status:
             return self
 
@@ -410,7 +971,7 @@ class tidyDB:
             else:
                 vars = [v.strip() for v in query.split(",")]
                 front = ", ".join(self.grouped_vars) + ", "
-            self.selected_fields = front + ", ".join([f"max({i}) as {i}_max" for i in vars])
+            self.aggregate(front + ", ".join([f"max({i}) as {i}_max" for i in vars]))
         if self.pipe_status:
             return self
 
@@ -425,7 +986,7 @@ class tidyDB:
             else:
                 vars = [v.strip() for v in query.split(",")]
                 front = ", ".join(self.grouped_vars) + ", "
-            self.selected_fields = front + ", ".join([f"min({i}) as {i}_min, max({i}) as {i}_max" for i in vars])
+            self.aggregate(front + ", ".join([f"min({i}) as {i}_min, max({i}) as {i}_max" for i in vars]))
         if self.pipe_status:
             return self
 
@@ -440,7 +1001,7 @@ class tidyDB:
             else:
                 vars = [v.strip() for v in query.split(",")]
                 front = ", ".join(self.grouped_vars) + ", "
-            self.selected_fields = front + ", ".join([f"sum({i}) as {i}_sum" for i in vars])
+            self.aggregate(front + ", ".join([f"sum({i}) as {i}_sum" for i in vars]))
         if self.pipe_status:
             return self
 
@@ -449,7 +1010,7 @@ class tidyDB:
         Count up the number of entries by the grouped variables.
         '''
         if self.is_grouped():
-            self.selected_fields = ", ".join(self.grouped_vars) + ", count(*) as n"
+            self.aggregate(", ".join(self.grouped_vars) + ", count(*) as n")
         if self.pipe_status:
             return self
 
@@ -458,10 +1019,57 @@ class tidyDB:
         Count up the number of entries by the grouped variables.
         '''
         if self.is_grouped():
-            self.selected_fields = ", ".join(self.grouped_vars) + f", count(*) as n, 1.0 * count(*)/(select count(*) FROM '{self.target_table}') as prop"
+            self.aggregate(", ".join(self.grouped_vars) + f", count(*) as n, 1.0 * count(*)/(select count(*) FROM '{self.target_table}') as prop")
         if self.pipe_status:
             return self
 
+    # Grouped slices
+    def slice_rows(self,order,n,by,with_ties):
+        '''
+        [Aux] Keep the first n rows per group by `order`, computed inside SQLite
+        with a window function. Uses the group_by() variables when `by` is not
+        given; they stay set so a later count()/mean()/... aggregates per group.
+        Chained slices each apply to the rows kept by the previous one.
+        '''
+        self.is_queued()
+        if by is not None:
+            partition = [v.strip() for v in by.split(",")]
+        else:
+            partition = list(self.grouped_vars)
+        self.grouping_sliced = self.is_grouped()
+        self.slice_specs.append((partition,order,int(n),"rank" if with_ties else "row_number"))
+        self.arranged_vars = [(v,"asc") for v in partition] + [("tidy_row_number","asc")]
+        self.arrange_statement = "order by " + ", ".join(f"{var} {o}" for var, o in self.arranged_vars)
+        if self.pipe_status:
+            return self
+
+    def slice_max(self,query,n=1,by=None,with_ties=False):
+        '''
+        Keep the n rows with the largest values of a variable within each group.
+
+        Groups come from `by` or the group_by() variables. with_ties=True keeps
+        rows tied with the n-th value. Example:
+            db.group_by("country_txt").slice_max("nkill",n=5).select("country_txt,eventid,nkill").collect()
+        '''
+        return self.slice_rows(f"{query} desc",n,by,with_ties)
+
+    def slice_min(self,query,n=1,by=None,with_ties=False):
+        '''
+        Keep the n rows with the smallest values of a variable within each group (NULLs last).
+        '''
+        return self.slice_rows(f"{query} is null, {query} asc",n,by,with_ties)
+
+    def slice_head(self,n=1,by=None):
+        '''
+        Keep the first n rows within each group, in arrange() order (or rowid order).
+        '''
+        if len(self.arranged_vars) > 0:
+            order = ", ".join(f"{var} {o}" for var, o in self.arranged_vars)
+        else:
+            self.is_queued()
+            order = f'"{self.target_table}".rowid'
+        return self.slice_rows(order,n,by,False)
+
     # Clear fields for analysis
     def unselect(self):
         '''Clear selected fields'''
@@ -478,12 +1086,34 @@ class tidyDB:
     def unarrange(self):
         '''Clear filtered fields'''
         self.arrange_statement = ""
+        self.arranged_vars = []
         if self.pipe_status:
             return self
 
     def ungroup(self):
         '''Clear filtered fields'''
         self.groupby_statement = ""
+        self.grouped_vars = []
+        self.grouping_sliced = False
+        if self.pipe_status:
+            return self
+
+    def unsearch(self):
+        '''Clear full-text search'''
+        self.set_join("search",None)
+        if self.pipe_status:
+            return self
+
+    def unslice(self):
+        '''Clear slice_max/slice_min/slice_head'''
+        self.slice_specs = []
+        self.grouping_sliced = False
+        if self.pipe_status:
+            return self
+
+    def unfilter_spatial(self):
+        '''Clear bounding box/radius filter'''
+        self.set_join("spatial",None)
         if self.pipe_status:
             return self
 
@@ -497,60 +1127,439 @@ class tidyDB:
         self.selected_fields = "*"
         self.filter_statement = ""
         self.arrange_statement = ""
+        self.arranged_vars = []
         self.distinct_statement = ""
         self.groupby_statement = ""
+        self.join_statement = ""
+        self.joins = {}
+        self.slice_specs = []
+        self.grouped_vars = []
+        self.grouping_sliced = False
 
     # Render data
-    def collect(self):
+    def run_query(self,query,params=None,timeout=None,max_vm_steps=None,progress=None):
+        '''
+        [Aux] Execute a query under the time/VM step budget and return a data frame.
+
+        Per-call settings fall back on the connection defaults. A progress
+        handler counts VM steps and interrupts the statement once the budget
+        is spent; rows are fetched in batches so the budget also covers the
+        fetch. When tracing is on, execute/fetch/convert times are recorded
+        and a query event is emitted to the trace sinks.
+        '''
+        self.is_connected()
+        timeout = self.timeout if timeout is None else timeout
+        max_vm_steps = self.max_vm_steps if max_vm_steps is None else max_vm_steps
+        progress = self.progress if progress is None else progress
+        deadline = None if timeout is None else time.monotonic() + timeout
+        state = dict(steps=0,rows=0,reason=None)
+        statements = []
+        timings = dict(execute_time=0.0,fetch_time=0.0,convert_time=0.0)
+
+        def handler():
+            state["steps"] += self.progress_interval
+            if progress is not None:
+                progress(state["steps"],state["rows"])
+            if max_vm_steps is not None and state["steps"] > max_vm_steps:
+                state["reason"] = f"exceeded {max_vm_steps} VM steps"
+                return 1
+            if deadline is not None and time.monotonic() > deadline:
+                state["reason"] = f"exceeded {timeout} seconds"
+                return 1
+            return 0
+
+        budgeted = any(v is not None for v in (timeout,max_vm_steps,progress))
+        traced = len(self.trace_sinks) > 0
+        if budgeted:
+            self.conn.set_progress_handler(handler,self.progress_interval)
+        if traced:
+            self.conn.set_trace_callback(statements.append)
+        error = None
+        started = time.perf_counter()
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute(query,() if params is None else params)
+            timings["execute_time"] = time.perf_counter() - started
+            columns = [col[0] for col in cursor.description or []]
+            rows = []
+            while True:
+                batch = cursor.fetchmany(10000)
+                if not batch:
+                    break
+                rows.extend(batch)
+                state["rows"] = len(rows)
+                if deadline is not None and time.monotonic() > deadline:
+                    state["reason"] = f"exceeded {timeout} seconds"
+                    raise QueryTimeout(f"Query {state['reason']} after fetching {state['rows']} rows.")
+            cursor.close()
+            timings["fetch_time"] = time.perf_counter() - started - timings["execute_time"]
+        except sqlite3.OperationalError as e:
+            error = e
+            if "interrupted" in str(e):
+                reason = state["reason"] or "was interrupted"
+                error = QueryTimeout(f"Query {reason} after fetching {state['rows']} rows.")
+                raise error from e
+            raise
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if budgeted:
+                self.conn.set_progress_handler(None,self.progress_interval)
+            if traced:
+                self.conn.set_trace_callback(None)
+                if error is not None:
+                    self.emit_trace(query,params,statements,state["rows"],0,timings,
+                                    time.perf_counter() - started,error)
+        if progress is not None:
+            progress(state["steps"],state["rows"])
+        convert_start = time.perf_counter()
+        out = pd.DataFrame.from_records(rows,columns=columns,coerce_float=True)
+        timings["convert_time"] = time.perf_counter() - convert_start
+        if traced:
+            total_time = time.perf_counter() - started # measured before sizing the frame
+            self.emit_trace(query,params,statements,len(out),
+                            int(out.memory_usage(deep=self.trace_deep_bytes).sum()),timings,
+                            total_time)
+        return out
+
+    # Query tracing
+    def trace(self,sink=None,slow_query=None,deep_bytes=False):
+        """Attach a sink that receives an event for every executed query.
+
+        Parameters
+        ----------
+        sink : callable
+            Called with an event dict holding the SQL text, params, the
+            statements seen by the SQLite trace callback, rows, bytes of the
+            result, and execute/fetch/convert/total times (seconds). Defaults
+            to a LoggingSink. See also RingBufferSink and JSONLinesSink.
+        slow_query : float
+            Only pass on queries whose total time is at least this many seconds.
+        deep_bytes : bool
+            Size text columns cell by cell (pandas memory_usage(deep=True)).
+            Exact but slow on wide text results; by default only the shallow
+            size is reported. Never counted in the query times.
+
+        Returns
+        -------
+        callable
+            The attached sink.
+
+        Examples
+        -------
+        from tidysqlite import tidyDB, RingBufferSink
+        db = tidyDB("~/my_database.sqlite")
+        buffer = db.trace(RingBufferSink())
+        db.trace(slow_query=1.0) # log slow queries
+        """
+        if sink is None:
+            sink = LoggingSink(level=logging.INFO if slow_query is None else logging.WARNING)
+        self.trace_sinks.append((sink,slow_query))
+        self.trace_deep_bytes = self.trace_deep_bytes or deep_bytes
+        return sink
+
+    def untrace(self):
+        '''
+        Detach all trace sinks and reset the per-statement stats.
+        '''
+        self.trace_sinks = []
+        self.trace_stats = {}
+        self.trace_deep_bytes = False
+
+    def emit_trace(self,query,params,statements,rows,nbytes,timings,total_time,error=None):
+        '''
+        [Aux] Build a query event, update the per-statement stats and pass it to the sinks.
+        '''
+        sql = " ".join(query.split())
+        event = dict(timestamp=time.time(),sql=sql,params=params,
+                     statements=statements,rows=rows,bytes=nbytes,
+                     total_time=total_time,error=None if error is None else repr(error),
+                     **timings)
+        stats = self.trace_stats.setdefault(sql,dict(calls=0,errors=0,rows=0,
+                                                     total_time=0.0,max_time=0.0))
+        stats["calls"] += 1
+        stats["errors"] += error is not None
+        stats["rows"] += rows
+        stats["total_time"] += total_time
+        stats["max_time"] = max(stats["max_time"],total_time)
+        for sink, slow_query in self.trace_sinks:
+            if slow_query is None or total_time >= slow_query:
+                sink(event)
+
+    def query_stats(self):
+        '''
+        Return aggregated per-statement stats for traced queries, slowest first.
+        '''
+        stats = pd.DataFrame([dict(sql=k,**v) for k, v in self.trace_stats.items()],
+                             columns=["sql","calls","errors","rows","total_time","max_time"])
+        stats["mean_time"] = stats["total_time"]/stats["calls"]
+        return stats.sort_values("total_time",ascending=False).reset_index(drop=True)
+
+    def interrupt(self):
+        '''
+        Cancel the query currently running on the connection (e.g. from another thread).
+        The running collect()/head() raises QueryTimeout and the query state is kept.
+        '''
+        self.is_connected()
+        self.conn.interrupt()
+
+    def compact_frame(self,data,max_category_ratio=0.5,probe_size=10000):
+        '''
+        [Aux] Shrink the memory footprint of a collected data frame.
+
+        Text columns whose cardinality (probed on the first `probe_size`
+        values) is at most `max_category_ratio` become categoricals built from
+        factorized codes. Integer columns are downcast to the smallest safe
+        width; integer columns holding NULLs (declared INTEGER in the schema
+        catalog, returned as float) become nullable integers.
+        '''
+        schema = self.gather_schema() if self.target_table is not None else {}
+        for col in data.columns:
+            values = data[col]
+            if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+                probe = values.iloc[:probe_size].dropna()
+                if len(probe) == 0 or not all(isinstance(v,str) for v in probe):
+                    continue
+                if probe.nunique() <= max_category_ratio*len(probe):
+                    codes, categories = pd.factorize(values,use_na_sentinel=True)
+                    data[col] = pd.Categorical.from_codes(codes,categories=categories)
+            elif pd.api.types.is_integer_dtype(values):
+                data[col] = pd.to_numeric(values,downcast="integer")
+            elif pd.api.types.is_float_dtype(values) and "INT" in schema.get(col,""):
+                non_null = values.dropna()
+                if len(non_null) == 0 or not (non_null == non_null.round()).all():
+                    continue
+                lo, hi = non_null.min(), non_null.max()
+                for dtype in ("Int8","Int16","Int32","Int64"):
+                    info = np.iinfo(dtype.lower())
+                    if info.min <= lo and hi <= info.max:
+                        data[col] = values.astype(dtype)
+                        break
+        return data
+
+    def collect(self,compact=False,timeout=None,max_vm_steps=None,progress=None):
         '''
         Execute constructed query on all available data.
+
+        compact=True returns low-cardinality text as categoricals and downcast
+        (nullable) integers (see compact_frame()).
+        timeout, max_vm_steps and progress override the connection defaults for
+        this call. On QueryTimeout the query state is left intact for a retry.
         '''
         self.is_queued() # Ensure a table is queued.
-        self.prior_query = pd.read_sql(f"""
+        self.prior_query = self.run_query(f"""
                                        SELECT {self.distinct_statement}
-                                       {self.selected_fields}
-                                       FROM '{self.target_table}'
-                                       {self.groupby_statement}
-                                       {self.filter_statement}
+                                       {self.render_fields()}
+                                       FROM {self.render_from()}
+                                       {self.render_where()}
+                                       {self.render_groupby()}
                                        {self.arrange_statement}
                                        """.strip(),
-                                       self.conn)
+                                       timeout=timeout,
+                                       max_vm_steps=max_vm_steps,
+                                       progress=progress)
+        if compact:
+            self.prior_query = self.compact_frame(self.prior_query)
         if self.pipe_status:
             self.clear()
             self.target_table = None
         return self.prior_query
 
-    def head(self,n=5):
+    def head(self,n=5,timeout=None,max_vm_steps=None,progress=None):
         '''
         Execute constructed query on first n entries of the data base.
         '''
         self.is_queued() # Ensure a table is queued .
-        self.prior_query = pd.read_sql(f"""
+        self.prior_query = self.run_query(f"""
                                        SELECT {self.distinct_statement}
-                                       {self.selected_fields}
-                                       FROM '{self.target_table}'
-                                       {self.filter_statement}
-                                       {self.groupby_statement}
+                                       {self.render_fields()}
+                                       FROM {self.render_from()}
+                                       {self.render_where()}
+                                       {self.render_groupby()}
                                        {self.arrange_statement}
                                        LIMIT {n}
                                        """.strip(),
-                                       self.conn)
+                                       timeout=timeout,
+                                       max_vm_steps=max_vm_steps,
+                                       progress=progress)
         if self.pipe_status:
             self.clear()
             self.target_table = None
         return self.prior_query
 
-    def custom_query(self,query=""):
+    def custom_query(self,query="",params=None,timeout=None,max_vm_steps=None,progress=None):
         '''
         Method to build and specify your own query from scratch.
         '''
-        self.prior_query = pd.read_sql(query,self.conn)
+        self.prior_query = self.run_query(query,params=params,timeout=timeout,
+                                          max_vm_steps=max_vm_steps,
+                                          progress=progress)
         return self.prior_query
 
+    # Keyset pagination
+    def keyset_state(self,order_by=None):
+        '''
+        [Aux] Capture the query state needed to page through the queued table.
+        '''
+        self.is_queued()
+        if self.distinct_statement != "" or self.render_groupby() != "" or len(self.slice_specs) > 0:
+            raise ValueError("Keyset pagination does not support distinct(), group_by() or slice verbs.")
+        keys = self.parse_arrange(order_by) if order_by is not None else list(self.arranged_vars)
+        # rowid follows the sort direction when it is uniform so the seek stays one row-value range.
+        directions = {order for _, order in keys}
+        tie = directions.pop() if len(directions) == 1 else "asc"
+        keys = keys + [(f'"{self.target_table}".rowid',tie)]
+        info = {col[1].lower(): col for col in self.conn.execute(f'PRAGMA table_info("{self.target_table}")')}
+
+        def not_null(key):
+            table, _, name = key.rpartition(".")
+            table, name = table.strip().strip('"\'`[]'), name.strip().strip('"\'`[]').lower()
+            if table not in ("", self.target_table):
+                return False
+            if name in ("rowid","oid","_rowid_"):
+                return True
+            col = info.get(name)
+            return col is not None and (col[3] == 1 or (col[5] > 0 and col[2].upper() == "INTEGER"))
+
+        return dict(table=self.target_table,
+                    selected_fields=self.render_fields(),
+                    join=self.join_statement,
+                    filter=self.filter_statement[len("where "):].strip(),
+                    keys=keys,
+                    nullable=[not not_null(key) for key, _ in keys])
+
+    def fetch_page(self,state,page_size,after=None):
+        '''
+        [Aux] Fetch one page after the cursor token and return (data, next token).
+
+        The page starts at the sort keys of the last row of the previous page
+        (seek). When all keys share one direction this is a single row-value
+        range, which an index on the keys answers as a range scan regardless of
+        depth. Descending keys that may be NULL add an OR for the NULL tail,
+        which SQLite answers with an ordered index scan instead of a seek.
+        Mixed directions, and NULL values in the cursor, need an OR of per-key
+        ranges that cannot be served as one index seek.
+        '''
+        keys = state["keys"]
+        conditions = [] if state["filter"] == "" else [f"({state['filter']})"]
+        params = []
+        if after is not None:
+            values = json.loads(base64.urlsafe_b64decode(after.encode()).decode())
+            if len(values) != len(keys):
+                raise ValueError("Cursor token does not match the page sort keys.")
+            directions = {order for _, order in keys}
+            if len(directions) == 1 and None not in values:
+                op = ">" if directions == {"asc"} else "<"
+                seek = [f"({', '.join(k for k, _ in keys)}) {op} ({', '.join('?'*len(keys))})"]
+                params = list(values)
+                if op == "<":
+                    # NULLs sort last descending but fail the row-value comparison.
+                    for i, (key, _) in enumerate(keys):
+                        if state["nullable"][i]:
+                            seek.append("(" + " and ".join([f"{k} = ?" for k, _ in keys[:i]] + [f"{key} is null"]) + ")")
+                            params += values[:i]
+                conditions.append("(" + " or ".join(seek) + ")")
+            else:
+                # SQLite sorts NULL first ascending and last descending.
+                seek = []
+                for i, (key, order) in enumerate(keys):
+                    equal = [f"{k} is null" if v is None else f"{k} = ?" for (k, _), v in zip(keys[:i],values[:i])]
+                    if values[i] is None:
+                        after_key = f"{key} is not null" if order == "asc" else None
+                    else:
+                        after_key = f"{key} > ?" if order == "asc" else f"({key} < ? or {key} is null)"
+                    if after_key is None:
+                        continue
+                    seek.append("(" + " and ".join(equal + [after_key]) + ")")
+                    params += [v for v in values[:i] if v is not None] + ([] if values[i] is None else [values[i]])
+                conditions.append("(" + (" or ".join(seek) if seek else "0") + ")")
+        hidden = [f"__key{i}" for i in range(len(keys))]
+        data = self.run_query(f"""
+                              SELECT {state['selected_fields']},
+                              {', '.join(f'{k} as {h}' for (k, _), h in zip(keys,hidden))}
+                              FROM '{state['table']}' {state['join']}
+                              {'where ' + ' and '.join(conditions) if conditions else ''}
+                              order by {', '.join(f'{k} {order}' for k, order in keys)}
+                              LIMIT {int(page_size)}
+                              """.strip(),params=params)
+        token = None
+        if len(data) == page_size:
+            last = [None if pd.isna(v) else v.item() if hasattr(v,"item") else v
+                    for v in data[hidden].iloc[-1].tolist()]
+            token = base64.urlsafe_b64encode(json.dumps(last).encode()).decode()
+        return data.drop(columns=hidden), token
+
+    def page(self,page_size=100,after=None,order_by=None):
+        """Fetch a single page of the constructed query using keyset pagination.
+
+        Pages are ordered by the arrange() keys (or `order_by`) with rowid as
+        the tie-breaker. NULL sort keys are paged in SQLite order (first
+        ascending, last descending). Keys that all sort in one direction seek
+        through an index on them; mixed directions cannot be index seeks and
+        sort the remaining rows on every page.
+
+        Parameters
+        ----------
+        page_size : int
+            Number of rows per page.
+        after : str
+            Cursor token returned with the previous page. None for the first page.
+        order_by : str
+            Sort keys in arrange() syntax, e.g. "desc(nkill),iyear". Defaults to the arrange() keys.
+
+        Returns
+        -------
+        tuple
+            (data frame, cursor token for the next page or None on the last page).
+
+        Raises
+        ------
+        ValueError
+            When the query uses distinct() or group_by(), or the token does not match the sort keys.
+
+        Examples
+        -------
+        data, token = db.tbl("gtd").filter("iyear == 2000").arrange("country_txt").page(50)
+        data, token = db.tbl("gtd").filter("iyear == 2000").arrange("country_txt").page(50,after=token)
+        """
+        state = self.keyset_state(order_by)
+        self.prior_query, token = self.fetch_page(state,page_size,after)
+        if self.pipe_status:
+            self.clear()
+            self.target_table = None
+        return self.prior_query, token
+
+    def paginate(self,page_size=100,order_by=None,after=None):
+        '''
+        Iterate over the constructed query one keyset page (data frame) at a time.
+        The query state is captured (and the pipe cleared) when paginate() is
+        called, not when iteration starts.
+
+        Example:
+            for chunk in db.tbl("gtd").arrange("iyear").paginate(10000):
+                ...
+        '''
+        state = self.keyset_state(order_by)
+        if self.pipe_status:
+            self.clear()
+            self.target_table = None
+
+        def pages(after):
+            while True:
+                data, after = self.fetch_page(state,page_size,after)
+                if len(data) > 0:
+                    yield data
+                if after is None:
+                    break
+
+        return pages(after)
+
     def create_table(self,data=None,table_name="",append=False,overwrite=False):
         '''
         Copy a data frame to the SQLite DB.
         '''
+        self.is_writable()
         self.gather_tables()
         rule = "fail"
         if table_name in self.tables:
@@ -560,6 +1569,11 @@ class tidyDB:
             if append:
                 rule = "append"
         data.to_sql(table_name, self.conn, if_exists=rule, index = False)
+        self.tables = None
+        self.schema.pop(table_name,None)
+        self.gather_tables()
+        if len(data) >= self.optimize_after_rows:
+            self.optimize()
 
     def create_database(self,path=""):
         '''
@@ -572,11 +1586,402 @@ class tidyDB:
         '''
         Delete a table from the connected SQLite DB
         '''
+        self.is_writable()
         out = input(f""" Do you really want to delete {table_name}? Y: yes N: No""")
         if out == "Y" or out.lower() == "yes":
             cursor = self.conn.cursor().execute(f"DROP TABLE {table_name};")
             self.tables = [t for t in self.tables if t != table_name]
 
+    # Bulk writes
+    def write_target(self,data,table_name,key=None):
+        '''
+        [Aux] Validate the table, data columns and key columns for a bulk write.
+        '''
+        self.is_connected()
+        self.gather_tables()
+        if table_name == "":
+            self.is_queued()
+            table_name = self.target_table
+        if table_name not in self.tables:
+            raise ValueError(f"{table_name} not in available tables.")
+        schema = self.gather_schema(table_name)
+        unknown = [c for c in data.columns if c not in schema]
+        if len(unknown) > 0:
+            raise ValueError(f"Fields {', '.join(unknown)} not in table '{table_name}'.")
+        keys = [k.strip() for k in key.split(",")] if isinstance(key,str) else list(key or [])
+        missing = [k for k in keys if k not in data.columns]
+        if len(missing) > 0:
+            raise ValueError(f"Key fields {', '.join(missing)} not in the data.")
+        nulls = [k for k in keys if data[k].isna().any()]
+        if len(nulls) > 0:
+            raise ValueError(f"Key fields {', '.join(nulls)} contain NULL values, which cannot be matched.")
+        return table_name, keys
+
+    def stage_records(self,data):
+        '''
+        [Aux] Convert a data frame to rows of sqlite3-compatible values, adapting
+        dates and times the way to_sql() (and so create_table()) stores them.
+        '''
+        def adapt(v):
+            if v is None or v is pd.NaT:
+                return None
+            if isinstance(v,datetime.datetime):
+                return v.isoformat(" ")
+            if isinstance(v,(datetime.date,datetime.time)):
+                return v.isoformat()
+            if isinstance(v,pd.Timedelta):
+                return v.value
+            if isinstance(v,np.generic):
+                return v.item()
+            return v
+
+        records = data.astype(object).where(data.notna(),None)
+        return ([adapt(v) for v in row] for row in records.itertuples(index=False,name=None))
+
+    def has_unique_key(self,table_name,keys):
+        '''
+        [Aux] Check whether a primary key or unique index covers exactly the key columns.
+        '''
+        info = self.conn.execute(f"PRAGMA table_info('{table_name}')").fetchall()
+        if set(col[1] for col in info if col[5] > 0) == set(keys):
+            return True
+        for index in self.conn.execute(f"PRAGMA index_list('{table_name}')").fetchall():
+            if index[2]:
+                cols = [c[2] for c in self.conn.execute(f"PRAGMA index_info('{index[1]}')").fetchall()]
+                if set(cols) == set(keys):
+                    return True
+        return False
+
+    def run_write(self,operation,table_name,statements,data=None):
+        '''
+        [Aux] Stage the data frame into a temp table and apply the write statements
+        in a single transaction. Returns a report of affected rows and throughput.
+        '''
+        self.is_writable()
+        started = time.perf_counter()
+        affected = 0
+        cursor = self.conn.cursor()
+        if self.conn.in_transaction:
+            self.conn.commit()
+        cursor.execute("BEGIN")
+        try:
+            if data is not None:
+                cols = ", ".join(f'"{c}"' for c in data.columns)
+                cursor.execute(f'CREATE TEMP TABLE tidy_stage AS SELECT {cols} FROM "{table_name}" WHERE 0')
+                cursor.executemany(f"INSERT INTO temp.tidy_stage VALUES ({', '.join('?'*len(data.columns))})",
+                                   self.stage_records(data))
+            for statement in statements:
+                cursor.execute(statement)
+                affected += cursor.rowcount
+            if data is not None:
+                cursor.execute("DROP TABLE temp.tidy_stage")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        seconds = time.perf_counter() - started
+        staged = 0 if data is None else len(data)
+        if max(staged,affected) >= self.optimize_after_rows:
+            self.optimize()
+        return dict(operation=operation,table=table_name,rows_staged=staged,
+                    rows_affected=affected,seconds=seconds,
+                    rows_per_second=max(staged,affected)/seconds if seconds > 0 else None)
+
+    def upsert(self,data=None,key="",table_name=""):
+        """Insert new rows and update existing ones matched on the key fields.
+
+        The data frame is staged into a temp table in bulk and applied in one
+        transaction. With a primary key or unique index on the key fields the
+        write is a single INSERT ... ON CONFLICT DO UPDATE; otherwise matching
+        rows are updated and the remaining rows inserted.
+
+        Parameters
+        ----------
+        data : pandas.DataFrame
+            Rows to write. Columns must exist in the table.
+        key : str
+            Comma separated key fields, e.g. "eventid" or "country,iyear".
+        table_name : str
+            Table to write to. Defaults to the queued table.
+
+        Returns
+        -------
+        dict
+            Report with rows staged, rows affected, seconds and rows per second.
+
+        Raises
+        ------
+        ValueError
+            When the table, data fields or key fields are unknown.
+
+        Examples
+        -------
+        db.tbl("tableA").upsert(dat,key="foo")
+        """
+        table_name, keys = self.write_target(data,table_name,key)
+        if len(keys) == 0:
+            raise ValueError("No key fields specified.")
+        cols = ", ".join(f'"{c}"' for c in data.columns)
+        values = [c for c in data.columns if c not in keys]
+        if self.has_unique_key(table_name,keys):
+            action = "DO NOTHING" if len(values) == 0 else \
+                "DO UPDATE SET " + ", ".join(f'"{c}" = excluded."{c}"' for c in values)
+            statements = [f"""INSERT INTO "{table_name}" ({cols})
+                              SELECT {cols} FROM temp.tidy_stage WHERE true
+                              ON CONFLICT ({', '.join(f'"{k}"' for k in keys)}) {action}"""]
+        else:
+            match = " AND ".join(f't."{k}" = s."{k}"' for k in keys)
+            statements = [] if len(values) == 0 else [self.update_statement(table_name,keys,values)]
+            statements.append(f"""INSERT INTO "{table_name}" ({cols})
+                                  SELECT {cols} FROM temp.tidy_stage AS s
+                                  WHERE NOT EXISTS (SELECT 1 FROM "{table_name}" AS t WHERE {match})""")
+        report = self.run_write("upsert",table_name,statements,data)
+        if self.pipe_status:
+            self.clear()
+            self.target_table = None
+        return report
+
+    def update_statement(self,table_name,keys,values):
+        '''
+        [Aux] Build an UPDATE ... FROM statement joining the staged rows on the key fields.
+        '''
+        return f"""UPDATE "{table_name}" AS t
+                   SET {', '.join(f'"{c}" = s."{c}"' for c in values)}
+                   FROM temp.tidy_stage AS s
+                   WHERE {' AND '.join(f't."{k}" = s."{k}"' for k in keys)}"""
+
+    def update(self,data=None,key="",table_name=""):
+        """Update existing rows matched on the key fields. Unmatched rows are ignored.
+
+        Parameters
+        ----------
+        data : pandas.DataFrame
+            Key fields plus the fields to overwrite.
+        key : str
+            Comma separated key fields.
+        table_name : str
+            Table to write to. Defaults to the queued table.
+
+        Returns
+        -------
+        dict
+            Report with rows staged, rows affected, seconds and rows per second.
+
+        Examples
+        -------
+        db.tbl("tableA").update(dat[["foo","x"]],key="foo")
+        """
+        table_name, keys = self.write_target(data,table_name,key)
+        values = [c for c in data.columns if c not in keys]
+        if len(keys) == 0 or len(values) == 0:
+            raise ValueError("Specify key fields and at least one field to update.")
+        report = self.run_write("update",table_name,[self.update_statement(table_name,keys,values)],data)
+        if self.pipe_status:
+            self.clear()
+            self.target_table = None
+        return report
+
+    def delete_rows(self):
+        """Delete the rows of the queued table that match the current filter().
+
+        Returns
+        -------
+        dict
+            Report with rows affected, seconds and rows per second.
+
+        Raises
+        ------
+        ValueError
+            When no filter is set. Use delete_table() to remove a whole table.
+
+        Examples
+        -------
+        db.tbl("tableA").filter("x < .5").delete_rows()
+        """
+        self.is_queued()
+        if self.filter_statement == "":
+            raise ValueError("No filter specified. delete_rows() only deletes rows matching filter().")
+        if self.join_statement != "" or len(self.slice_specs) > 0:
+            raise ValueError("delete_rows() does not support search(), spatial filters or slice verbs. Use filter() only.")
+        report = self.run_write("delete",self.target_table,
+                                [f'DELETE FROM "{self.target_table}" {self.filter_statement}'])
+        if self.pipe_status:
+            self.clear()
+            self.target_table = None
+        return report
+
+    # Maintenance
+    def optimize(self,analysis_limit=None):
+        '''
+        Run PRAGMA optimize so the query planner has fresh statistics. Cheap; runs
+        ANALYZE only on tables whose statistics are missing or stale. Called
+        automatically on close() and after ingests of optimize_after_rows or more rows.
+        Returns the time taken in seconds.
+        '''
+        self.is_writable()
+        started = time.perf_counter()
+        if analysis_limit is not None:
+            self.conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+        self.conn.execute("PRAGMA optimize")
+        self.conn.commit()
+        return time.perf_counter() - started
+
+    def maintenance(self,analyze=True,analysis_limit=None,vacuum="incremental",
+                    checkpoint=True,integrity="quick",exact_counts=False,page_counts=False):
+        """Run database maintenance and report storage and statistics health.
+
+        Parameters
+        ----------
+        analyze : bool
+            Run ANALYZE to refresh the planner statistics (sqlite_stat1).
+        analysis_limit : int
+            Approximate number of index rows ANALYZE examines (PRAGMA analysis_limit). None scans everything.
+        vacuum : str
+            "incremental" reclaims free pages when the database uses auto_vacuum=INCREMENTAL,
+            "full" rebuilds the file with VACUUM, None skips vacuuming. VACUUM can
+            renumber rowids, so full-text and spatial indexes are rebuilt afterwards.
+        checkpoint : bool
+            Checkpoint and truncate the write-ahead log when the database is in WAL mode.
+        integrity : str
+            "quick" runs PRAGMA quick_check, "full" runs PRAGMA integrity_check, None skips.
+        exact_counts : bool
+            Count the rows of every table with count(*) (a full scan of each
+            table) and compare them with sqlite_stat1 to judge staleness.
+            Otherwise only tables that were never analyzed are flagged stale.
+        page_counts : bool
+            Report the pages used by each table from dbstat (reads every page of the file).
+
+        Returns
+        -------
+        dict
+            'steps': data frame of each step with its result and time in seconds.
+            'database': page size, page count, freelist count and journal mode.
+            'tables': data frame with rows at last ANALYZE, whether the statistics are stale
+            (None when unknown), and the current rows and pages when requested.
+
+        Raises
+        ------
+        ValueError
+            When vacuum or integrity is not a known option.
+
+        Examples
+        -------
+        from tidysqlite import tidyDB
+        db = tidyDB("~/my_database.sqlite")
+        report = db.maintenance(analysis_limit=1000)
+        report["tables"]
+        """
+        self.is_writable()
+        if vacuum not in ("incremental","full",None) or integrity not in ("quick","full",None):
+            raise ValueError("vacuum must be 'incremental', 'full' or None; integrity must be 'quick', 'full' or None.")
+        self.conn.commit()
+        steps = []
+
+        def step(name,statement):
+            started = time.perf_counter()
+            result = self.conn.execute(statement).fetchall()
+            self.conn.commit()
+            steps.append(dict(step=name,result=", ".join(str(v) for row in result for v in row),
+                              seconds=time.perf_counter() - started))
+
+        if analyze:
+            if analysis_limit is not None:
+                self.conn.execute(f"PRAGMA analysis_limit = {int(analysis_limit)}")
+            step("analyze","ANALYZE")
+        if vacuum == "incremental":
+            step("incremental_vacuum","PRAGMA incremental_vacuum")
+        elif vacuum == "full":
+            step("vacuum","VACUUM")
+            started = time.perf_counter()
+            rebuilt = self.rebuild_indexes()
+            steps.append(dict(step="rebuild_indexes",result=", ".join(rebuilt),
+                              seconds=time.perf_counter() - started))
+        journal_mode = self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if checkpoint and journal_mode == "wal":
+            step("wal_checkpoint","PRAGMA wal_checkpoint(TRUNCATE)")
+        if integrity is not None:
+            step(f"{integrity}_check","PRAGMA quick_check" if integrity == "quick" else "PRAGMA integrity_check")
+
+        database = dict(page_size=self.conn.execute("PRAGMA page_size").fetchone()[0],
+                        page_count=self.conn.execute("PRAGMA page_count").fetchone()[0],
+                        freelist_count=self.conn.execute("PRAGMA freelist_count").fetchone()[0],
+                        journal_mode=journal_mode)
+        return dict(steps=pd.DataFrame(steps,columns=["step","result","seconds"]),
+                    database=database,tables=self.table_stats(exact_counts,page_counts))
+
+    def rebuild_indexes(self):
+        '''
+        [Aux] Rebuild the full-text and spatial indexes recorded in tidysqlite_indexes
+        from their base tables (e.g. after VACUUM renumbered rowids). Returns the
+        rebuilt index names.
+        '''
+        self.tables = None
+        self.gather_tables()
+        if "tidysqlite_indexes" not in self.index_tables:
+            return []
+        rebuilt = []
+        for name, table_name, kind, columns in self.conn.execute(
+                "SELECT name, table_name, kind, columns FROM tidysqlite_indexes").fetchall():
+            if name not in self.index_tables or table_name not in self.tables:
+                continue  # index or base table has since been dropped
+            if kind == "fts":
+                with self.conn:
+                    self.conn.execute(f"""INSERT INTO "{name}"("{name}") VALUES ('rebuild')""")
+            else:
+                lat, lon = columns.split(",")
+                self.create_spatial_index(lat,lon,table_name=table_name)
+            rebuilt.append(name)
+        return rebuilt
+
+    def table_stats(self,exact_counts=False,page_counts=False):
+        '''
+        [Aux] Report planner statistics freshness for each table. Exact row counts
+        (needed to judge staleness of analyzed tables) and page counts each scan
+        the data and are opt-in.
+        '''
+        self.tables = None
+        self.gather_tables()
+        pages = {}
+        if page_counts:
+            try:
+                pages = {name: n for name, n in self.conn.execute("SELECT name, pageno FROM dbstat WHERE aggregate = TRUE")}
+            except sqlite3.OperationalError:
+                pass  # dbstat is not compiled in
+        analyzed = {}
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sqlite_stat1'").fetchone():
+            for tbl, stat in self.conn.execute("SELECT tbl, stat FROM sqlite_stat1"):
+                analyzed[tbl] = max(analyzed.get(tbl,0),int(stat.split()[0]))
+        virtual = [t[0] for t in self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND sql LIKE 'CREATE VIRTUAL%'")]
+        stats = []
+        for table in self.tables:
+            if table in virtual:
+                continue  # index and shadow tables are already left out of self.tables
+            rows = self.conn.execute(f'SELECT count(*) FROM "{table}"').fetchone()[0] if exact_counts else None
+            stat_rows = analyzed.get(table)
+            if stat_rows is None:
+                stale = True
+            elif rows is None:
+                stale = None
+            else:
+                stale = abs(rows - stat_rows) > 0.1*max(stat_rows,1)
+            stats.append(dict(table=table,pages=pages.get(table),rows=rows,
+                              analyzed_rows=stat_rows,stale=stale))
+        return pd.DataFrame(stats,columns=["table","pages","rows","analyzed_rows","stale"])
+
+    def close(self):
+        '''
+        Run PRAGMA optimize (skipped for in-memory snapshots) and close the database connection.
+        '''
+        self.is_connected()
+        if self.source_conn is None and self.snapshot_uri is None:
+            self.optimize()
+        self.conn.close()
+        if self.source_conn is not None:
+            self.source_conn.close()
+        self.conn = None
+        self.source_conn = None
+        self.snapshot_uri = None
+
     # method attributes
     def __str__(self):
         self.gather_tables()
@@ -588,10 +1993,10 @@ class tidyDB:
         Current Query State:
 
             SELECT {self.distinct_statement}
-                {self.selected_fields}
-            FROM '{self.target_table}'
-            {self.filter_statement}
-            {self.groupby_statement}
+                {self.render_fields()}
+            FROM {self.render_from()}
+            {self.render_where()}
+            {self.render_groupby()}
             {self.arrange_statement}
         """.strip()
         return msg